@@ -27,6 +27,7 @@ setup(
     download_url='',
     license='MIT',
     install_requires=['paho-mqtt'],
+    extras_require={'orjson': ['orjson'], 'asyncio': ['aiomqtt>=2']},
     tests_require=['pytest'],
     cmdclass = {'test': PyTest},
     keywords=['snips', 'mqtt'],
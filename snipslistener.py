@@ -1,14 +1,41 @@
 import argparse
+import asyncio
 import collections
+import collections.abc
+import functools
 import inspect
 import json
 import logging
 import logging.config
+import sys
+import threading
 
 import paho.mqtt.client as mqtt
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import aiomqtt
+except ImportError:
+    aiomqtt = None
+
 LOG = logging.getLogger(__name__)
 
+# Payloads are decoded from and encoded to bytes, which is what paho hands us
+# and accepts for publishing, so no intermediate str is needed with orjson.
+if orjson is not None:
+    _loads = orjson.loads
+    _dumps = orjson.dumps
+else:
+    _loads = json.loads
+    _encode = json.JSONEncoder(separators=(',', ':'), ensure_ascii=False).encode
+
+    def _dumps(obj):
+        return _encode(obj).encode('utf-8')
+
 
 def intent(name, namespace=None):
     def decorate(func):
@@ -41,60 +68,104 @@ def session_ended(func=None):
 
 class SessionManager(object):
 
-    def __init__(self, session_id, site_id, mqtt):
+    # Batching state, only set up per instance when batching is enabled
+    _lock = None
+    _pending = None
+    _flush_timer = None
+
+    def __init__(self, session_id, site_id, mqtt, batch_window_ms=0):
         self.session_id = session_id
         self.site_id = site_id
         self.mqtt = mqtt
         self.ended = False
+        # Milliseconds to hold publishes for so that a burst of them is handed to
+        # the MQTT client together; 0 publishes immediately.
+        self.batch_window_ms = batch_window_ms
+        # JSON-encoded once per session and shared by every payload it publishes
+        self._session_id_json = _dumps(session_id)
+        self._text_prefix = b'{"sessionId":' + self._session_id_json + b',"text":'
+        self._say_prefix = (
+            b'{"sessionId":' + self._session_id_json + b',"siteId":' + _dumps(site_id) + b',"text":'
+        )
+        if batch_window_ms:
+            self._pending = []
+            self._lock = threading.Lock()
+
+    def _publish(self, topic, payload):
+        if self._lock is None:
+            self.mqtt.publish(topic, payload=payload, qos=0)
+            return
+
+        with self._lock:
+            self._pending.append((topic, payload))
+            if self._flush_timer is None:
+                self._flush_timer = threading.Timer(self.batch_window_ms / 1000, self._flush)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+
+    def _flush(self):
+        # Publish while holding the lock so a flush from the timer thread can't
+        # be overtaken by a later one from end_session().
+        if self._lock is None:
+            return
+        with self._lock:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+            pending, self._pending = self._pending, []
+            if self.ended:
+                # The dialogue manager ended the session while these were queued
+                return
+            for topic, payload in pending:
+                self.mqtt.publish(topic, payload=payload, qos=0)
+
+    def _discard_pending(self):
+        if self._lock is None:
+            return
+        with self._lock:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+            self._pending = []
 
     def continue_session(self, text, intent_filters=None):
         if self.ended:
             LOG.error("Trying to continue an already-ended session %s", self.session_id)
             return
 
-        payload = {
-            'sessionId': self.session_id,
-            'text': text
-        }
         if intent_filters:
-            payload['intentFilter'] = intent_filters
-        self.mqtt.publish(
-            'hermes/dialogueManager/continueSession',
-            payload=json.dumps(payload)
-        )
+            payload = self._text_prefix + _dumps(text) + b',"intentFilter":' + _dumps(intent_filters) + b'}'
+        else:
+            payload = self._text_prefix + _dumps(text) + b'}'
+        self._publish('hermes/dialogueManager/continueSession', payload)
 
     def say(self, text):
         if self.ended:
             LOG.error("Trying to say something an already-ended session %s", self.session_id)
             return
 
-        payload = {
-            'sessionId': self.session_id,
-            'siteId': self.site_id,
-            'text': text
-        }
-        self.mqtt.publish(
-            'hermes/tts/say',
-            payload=json.dumps(payload)
-        )
+        self._publish('hermes/tts/say', self._say_prefix + _dumps(text) + b'}')
 
     def end_session(self, text=None):
         if self.ended:
             LOG.error("Trying to end an already-ended session %s", self.session_id)
             return
 
-        payload = {
-            'sessionId': self.session_id,
-        }
         if text:
-            payload['text'] = text
-        self.mqtt.publish(
-            'hermes/dialogueManager/endSession',
-            payload=json.dumps(payload)
-        )
+            payload = self._text_prefix + _dumps(text) + b'}'
+        else:
+            payload = b'{"sessionId":' + self._session_id_json + b'}'
+        self._publish('hermes/dialogueManager/endSession', payload)
+        if self._lock is not None:
+            # Don't hold up closing the session
+            self._flush()
         self.ended = True
 
 
+_INTENT_PREFIX_LEN = len("hermes/intent/")
+_HOTWORD_PREFIX_LEN = len("hermes/hotword/")
+_HOTWORD_SUFFIX_LEN = len("/detected")
+
 HotwordDetected = collections.namedtuple('HotwordDetected', ('hotword_id', 'model_id', 'site_id'))
 IntentDetected = collections.namedtuple('IntentDetected', (
     'session_id', 'site_id', 'custom_data', 'input', 'intent_name', 'probability', 'slots', 'session_manager'
@@ -105,28 +176,128 @@ SessionEnded = collections.namedtuple('SessionEnded', ('session_id', 'site_id',
 ContinueSession = collections.namedtuple('ContinueSession', ('text', 'intent_filters'))
 
 
+# Skills only handle a bounded set of intent names, so the namespace split is
+# cached rather than redone for every message.
+@functools.lru_cache(maxsize=256)
+def _strip_namespace(intent_name):
+    _, sep, name = intent_name.partition(':')
+    if sep:
+        return sys.intern(name)
+    return None
+
+
+def _make_slot(s, input_text):
+    start = s['range']['start']
+    end = s['range']['end']
+    value = s['value']
+    return Slot(
+        slot_name=s['slotName'],
+        raw_value=s['rawValue'],
+        value=value['value'],
+        value_kind=value['kind'],
+        range=Range(start=start, end=end),
+        entity=s['entity'],
+        text=input_text[start:end]
+    )
+
+
+class _LazySlots(collections.abc.Mapping):
+    """
+    Read-only mapping of slot name to Slot, which only builds the Slot objects
+    from the raw intent payload when a handler first accesses the slots.
+    """
+
+    def __init__(self, raw_slots, input_text):
+        self._raw_slots = raw_slots
+        self._input_text = input_text
+        self._slots = None
+
+    def _materialize(self):
+        if self._slots is None:
+            input_text = self._input_text
+            self._slots = {s['slotName']: _make_slot(s, input_text) for s in self._raw_slots}
+        return self._slots
+
+    def __getitem__(self, key):
+        return self._materialize()[key]
+
+    def __iter__(self):
+        return iter(self._materialize())
+
+    def __len__(self):
+        return len(self._materialize())
+
+    def __repr__(self):
+        return repr(self._materialize())
+
+
 class SnipsListener(object):
 
-    def __init__(self, mqtt_host, mqtt_port=1883):
-        self.mqtt_host = mqtt_host
-        self.mqtt_port = mqtt_port
-        self._mqtt_client = None
-        self._intent_handlers = collections.defaultdict(list)
-        self._hotword_detected_handlers = set()
-        self._session_ended_handlers = set()
-        self._suspended_sessions = {}
-        self._session_managers = {}
-        for attrname in dir(self):
+    # Names of decorated handler methods, collected once per class by
+    # __init_subclass__. Intent handlers are (attribute name,
+    # is_generator_function) pairs keyed by the full intent name as sent by
+    # Snips, i.e. "namespace:name" for namespaced handlers and plain "name" for
+    # ones matching any namespace.
+    _intent_table = {}
+    _hotword_detected_table = ()
+    _session_ended_table = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        attrnames = set()
+        for klass in cls.__mro__:
+            attrnames.update(vars(klass))
+        intent_table = {}
+        hotword_detected_table = []
+        session_ended_table = []
+        for attrname in sorted(attrnames):
             if attrname[:2] != '__':
-                attr = getattr(self, attrname)
+                # Look attributes up on the class, so that subclass overrides win
+                # and static/class methods are unwrapped, without evaluating any
+                # properties as an instance lookup would.
+                attr = getattr(cls, attrname)
                 if callable(attr):
                     if hasattr(attr, '_handles_intent'):
-                        for intent_desc in attr._handles_intent:
-                            self._intent_handlers[intent_desc].append(attr)
+                        is_gen = inspect.isgeneratorfunction(attr)
+                        for name, namespace in attr._handles_intent:
+                            if namespace is not None:
+                                name = namespace + ':' + name
+                            intent_table.setdefault(sys.intern(name), []).append((attrname, is_gen))
                     if getattr(attr, '_handles_hotword_detected', False):
-                        self._hotword_detected_handlers.add(attr)
+                        hotword_detected_table.append(attrname)
                     if getattr(attr, '_handles_session_ended', False):
-                        self._session_ended_handlers.add(attr)
+                        session_ended_table.append(attrname)
+        cls._intent_table = {name: tuple(handlers) for name, handlers in intent_table.items()}
+        cls._hotword_detected_table = tuple(hotword_detected_table)
+        cls._session_ended_table = tuple(session_ended_table)
+
+    def __init__(self, mqtt_host, mqtt_port=1883, debug=False, batch_window_ms=0):
+        self.mqtt_host = mqtt_host
+        self.mqtt_port = mqtt_port
+        # Whether to subscribe to and log the ASR and NLU debug topics
+        self.debug = debug
+        # How long sessions may hold back publishes to send them together
+        self.batch_window_ms = batch_window_ms
+        self._mqtt_client = None
+        # Session id -> (generator, SessionManager) for multi-turn dialogues
+        self._suspended_sessions = {}
+        # Outstanding tasks under loop_forever_async(), and the latest one for
+        # each session id
+        self._tasks = set()
+        self._session_tasks = {}
+        # Bind this instance's handlers from the class tables. They are iterated on
+        # every message, so they're frozen rather than copied on each dispatch;
+        # runtime (un)registration replaces the frozenset.
+        self._intent_handlers = {
+            name: tuple((getattr(self, attrname), is_gen) for attrname, is_gen in handlers)
+            for name, handlers in self._intent_table.items()
+        }
+        self._hotword_detected_handlers = frozenset(
+            getattr(self, attrname) for attrname in self._hotword_detected_table
+        )
+        self._session_ended_handlers = frozenset(
+            getattr(self, attrname) for attrname in self._session_ended_table
+        )
 
     # The callback for when the client receives a CONNACK response from the server.
     def on_connect(self, client, userdata, flags, rc):
@@ -134,188 +305,271 @@ class SnipsListener(object):
 
         # Subscribing in on_connect() means that if we lose the connection and
         # reconnect then subscriptions will be renewed.
-        # TODO: only subscribe to recognized intents?
-        client.subscribe("hermes/intent/#")
-        client.subscribe("hermes/hotword/+/detected")
-        client.subscribe("hermes/dialogueManager/sessionEnded")
-        client.subscribe("hermes/nlu/#")
-        client.subscribe("hermes/asr/#")
-        # client.subscribe("hermes/dialogueManager/#")
+        client.subscribe(self._subscriptions())
+
+    def _subscriptions(self):
+        # All topics go in a single SUBSCRIBE packet, at QoS 0 since every extra
+        # QoS level adds a round trip with the broker per message.
+        topics = self._intent_topics()
+        topics.append("hermes/hotword/+/detected")
+        topics.append("hermes/dialogueManager/sessionEnded")
+        if self.debug:
+            topics.append("hermes/nlu/#")
+            topics.append("hermes/asr/#")
+        # topics.append("hermes/dialogueManager/#")
+        return [(topic, 0) for topic in topics]
+
+    def _message_callbacks(self, asynchronous=False):
+        if asynchronous:
+            handle_intent = self._receive_intent
+            handle_hotword_detected = self._receive_hotword_detected
+            handle_session_ended = self._receive_session_ended
+        else:
+            handle_intent = self._handle_intent
+            handle_hotword_detected = self._handle_hotword_detected
+            handle_session_ended = self._handle_session_ended
+        callbacks = []
+        if self.debug:
+            # These are here just to print random info for you
+            callbacks.append(("hermes/asr/#", self.asr))
+            callbacks.append(("hermes/nlu/#", self.nlu))
+
+        # Register for the same intent topics we subscribe to, so other intents
+        # never reach _handle_intent
+        for topic in self._intent_topics():
+            callbacks.append((topic, handle_intent))
+        callbacks.append(("hermes/hotword/+/detected", handle_hotword_detected))
+        callbacks.append(("hermes/dialogueManager/sessionEnded", handle_session_ended))
+        return callbacks
+
+    def _intent_topics(self):
+        # Handlers without a namespace match the intent name in any namespace,
+        # and generator handlers can be resumed by any intent the user replies
+        # with, so both of those need the whole intent topic tree. Otherwise the
+        # broker only needs to send us the intents we actually handle.
+        topics = []
+        for name, handlers in self._intent_handlers.items():
+            if ':' not in name or any(is_gen for _, is_gen in handlers):
+                return ["hermes/intent/#"]
+            topics.append("hermes/intent/" + name)
+        return topics
 
     def asr(self, client, userdata, msg):
-        LOG.debug("ASR debug: %s -> %s", msg.topic, msg.payload.decode())
+        if LOG.isEnabledFor(logging.DEBUG):
+            LOG.debug("ASR debug: %s -> %s", msg.topic, msg.payload.decode())
 
     def nlu(self, client, userdata, msg):
-        LOG.debug("NLU debug: %s -> %s", msg.topic, msg.payload.decode())
+        if LOG.isEnabledFor(logging.DEBUG):
+            LOG.debug("NLU debug: %s -> %s", msg.topic, msg.payload.decode())
 
     # def dialogueManager(self, client, userdata, msg):
-    #     data = json.loads(msg.payload.decode())
+    #     data = _loads(msg.payload)
     #     print(data)
     #     print(msg.topic+" "+str(msg.payload.decode()))
 
     def _register_session_end_handler(self, handler):
-        self._session_ended_handlers.add(handler)
+        self._session_ended_handlers = self._session_ended_handlers | {handler}
 
     def _unregister_session_end_handler(self, handler):
-        self._session_ended_handlers.remove(handler)
-
-    # The callback for when a PUBLISH message is received from the server.
-    def _handle_intent(self, client, userdata, msg):
-        LOG.debug(msg.topic+" "+str(msg.payload.decode()))
-        data = json.loads(msg.payload.decode())
+        handlers = set(self._session_ended_handlers)
+        handlers.remove(handler)
+        self._session_ended_handlers = frozenset(handlers)
+
+    def _find_intent_handlers(self, intent_name):
+        if LOG.isEnabledFor(logging.DEBUG):
+            LOG.debug("Looking for %s in %s", intent_name, list(self._intent_handlers))
+        handlers = self._intent_handlers.get(intent_name)
+        if handlers is None:
+            bare_name = _strip_namespace(intent_name)
+            if bare_name is not None:
+                # Try again with no namespace
+                handlers = self._intent_handlers.get(bare_name)
+        LOG.debug("Lookup result: %s", handlers)
+        return handlers
+
+    def _parse_intent(self, msg, sessions_active):
+        payload = msg.payload
+        if LOG.isEnabledFor(logging.DEBUG):
+            LOG.debug("%s %s", msg.topic, payload.decode())
+        handlers = None
+        if not sessions_active:
+            # There's no session this intent could be resuming, so look up its
+            # handlers by the intent name in the topic and drop unhandled intents
+            # without parsing their payload.
+            handlers = self._find_intent_handlers(msg.topic[_INTENT_PREFIX_LEN:])
+            if handlers is None:
+                return None
+        return _loads(payload), handlers
+
+    def _start_intent(self, client, data, handlers):
         intent_data = data['intent']
+        # There are only a handful of distinct intent names and site ids, so intern
+        # them for identity comparisons in dict lookups. Session ids are unique per
+        # dialogue, so interning them would only grow the interned string table.
         session_id = data['sessionId']
-        site_id = data['siteId']
-        LOG.debug("data.sessionId="+str(session_id))
-        LOG.debug("data.intent="+str(intent_data))
-        LOG.debug("data.slots="+str(data['slots']))
+        site_id = sys.intern(data['siteId'])
+        intent_name = sys.intern(intent_data['intentName'])
+        if LOG.isEnabledFor(logging.DEBUG):
+            LOG.debug("data.sessionId=%s", session_id)
+            LOG.debug("data.intent=%s", intent_data)
+            LOG.debug("data.slots=%s", data.get('slots'))
 
         gen_obj = None
-        handlers = None
-        if session_id in self._suspended_sessions:
+        suspended = self._suspended_sessions.get(session_id)
+        if suspended is not None:
             # Resuming a suspended session
-            gen_obj = self._suspended_sessions[session_id]
+            gen_obj, session_manager = suspended
             LOG.debug("Resuming suspended session %s", session_id)
-        else:
+        elif handlers is None:
             # New session
-            split_name = intent_data['intentName'].split(':', 1)
-            if len(split_name) == 1:
-                # no namespace
-                lookup = (split_name[0], None)
-            else:
-                # name with namespace
-                lookup = (split_name[1], split_name[0])
+            handlers = self._find_intent_handlers(intent_name)
 
-            LOG.debug("Looking for {} in {}".format(lookup, self._intent_handlers.keys()))
-            handlers = self._intent_handlers.get(lookup)
-            if handlers is None and lookup[1] is not None:
-                # Try again with no namespace
-                handlers = self._intent_handlers.get((lookup[0], None))
-            LOG.debug("Lookup result: {}".format(handlers))
+        if handlers is None and gen_obj is None:
+            return None
 
-        if handlers is not None or gen_obj is not None:
-            if session_id in self._session_managers:
-                session_manager = self._session_managers[session_id]
-            else:
-                session_manager = SessionManager(session_id=session_id, site_id=site_id, mqtt=client)
-                self._session_managers[session_id] = session_manager
-            intent_obj = IntentDetected(
-                session_id=session_id,
-                site_id=site_id,
-                custom_data=data.get('customData'),
-                input=data['input'],
-                intent_name=intent_data['intentName'],
-                probability=intent_data.get('confidenceScore', intent_data.get('probability', 1.0)),
-                slots={
-                    s['slotName']: Slot(
-                        slot_name=s['slotName'],
-                        raw_value=s['rawValue'],
-                        value=s['value']['value'],
-                        value_kind=s['value']['kind'],
-                        range=Range(start=s['range']['start'], end=s['range']['end']),
-                        entity=s['entity'],
-                        text=data['input'][s['range']['start']:s['range']['end']]
-                    )
-                    for s in data.get('slots', [])
-                },
-                session_manager=session_manager
+        input_text = data['input']
+        if gen_obj is None:
+            # Only kept beyond this message if a generator handler suspends the session
+            session_manager = SessionManager(
+                session_id=session_id, site_id=site_id, mqtt=client, batch_window_ms=self.batch_window_ms
             )
+        intent_obj = IntentDetected(
+            session_id=session_id,
+            site_id=site_id,
+            custom_data=data.get('customData'),
+            input=input_text,
+            intent_name=intent_name,
+            probability=intent_data.get('confidenceScore', intent_data.get('probability', 1.0)),
+            slots=_LazySlots(data.get('slots', ()), input_text),
+            session_manager=session_manager
+        )
+        LOG.debug("Intent object: %r", intent_obj)
+        return intent_obj, gen_obj, handlers
 
-            LOG.debug("Intent object: {!r}".format(intent_obj))
-            if gen_obj is not None:
-                # Resumed session
-                LOG.debug("Sending into generator for %s", session_id)
-                self._do_generator_turn(gen_obj, intent_obj, session_id)
-            else:
-                # new session
-                for h in handlers.copy():
-                    try:
-                        if inspect.isgeneratorfunction(h):
-                            # Deal with intent handlers as generators
-                            LOG.debug("Getting generator from {}".format(h))
-                            gen_obj = h(intent_obj)
-                            self._do_generator_turn(gen_obj, intent_obj, session_id, is_start=True)
-                        else:
-                            h(intent_obj)
-                    except Exception as exc:
-                        LOG.exception("Exception in %s: %s", h, exc)
-
-    def _do_generator_turn(self, gen_obj, intent_obj, session_id, is_start=False):
-        try:
-            if is_start:
-                turn = next(gen_obj)
-            else:
-                turn = gen_obj.send(intent_obj)
-        except StopIteration as exc:
-            if session_id in self._suspended_sessions:
-                del self._suspended_sessions[session_id]
-            if exc.value:
-                intent_obj.session_manager.end_session(exc.value)
+    # The callback for when a PUBLISH message is received from the server.
+    def _handle_intent(self, client, userdata, msg):
+        parsed = self._parse_intent(msg, self._suspended_sessions)
+        if parsed is None:
+            return
+        started = self._start_intent(client, *parsed)
+        if started is None:
+            return
+
+        intent_obj, gen_obj, handlers = started
+        if gen_obj is not None:
+            # Resumed session
+            LOG.debug("Sending into generator for %s", intent_obj.session_id)
+            self._do_generator_turn(gen_obj, intent_obj)
+        else:
+            # new session
+            for h, is_gen in handlers:
+                try:
+                    if is_gen:
+                        # Deal with intent handlers as generators
+                        LOG.debug("Getting generator from %s", h)
+                        self._do_generator_turn(h(intent_obj), intent_obj, is_start=True)
+                    else:
+                        h(intent_obj)
+                except Exception as exc:
+                    LOG.exception("Exception in %s: %s", h, exc)
+
+    def _do_generator_turn(self, gen_obj, intent_obj, is_start=False):
+        finished, result = _advance_generator(gen_obj, intent_obj, is_start)
+        if not self._apply_generator_turn(gen_obj, intent_obj, finished, result):
+            _reject_turn(gen_obj)
+
+    def _apply_generator_turn(self, gen_obj, intent_obj, finished, result):
+        """
+        Update the session after an intent handler generator has run up to its
+        next yield (or returned). Returns False if it yielded something invalid.
+        """
+        session_id = intent_obj.session_id
+        if finished:
+            self._suspended_sessions.pop(session_id, None)
+            if result:
+                intent_obj.session_manager.end_session(result)
             else:
                 intent_obj.session_manager.end_session()
+            return True
+
+        # Exact type check first for the common case of plain text
+        if type(result) is str:
+            text, intent_filters = result, None
+        elif isinstance(result, tuple) and len(result) == 2:
+            # Also covers ContinueSession
+            text, intent_filters = result
+        elif isinstance(result, str):
+            text, intent_filters = result, None
         else:
-            if isinstance(turn, str):
-                self._suspended_sessions[session_id] = gen_obj
-                intent_obj.session_manager.continue_session(turn)
-            elif len(turn) == 2:
-                self._suspended_sessions[session_id] = gen_obj
-                intent_obj.session_manager.continue_session(text=turn[0], intent_filters=turn[1])
-            else:
-                gen_obj.throw(TypeError(
-                    "Intent handler generators must yield text or (text: str, intent_filters: list)"
-                ))
+            return False
+        self._suspended_sessions[session_id] = (gen_obj, intent_obj.session_manager)
+        intent_obj.session_manager.continue_session(text=text, intent_filters=intent_filters)
+        return True
 
-    def _handle_hotword_detected(self, client, userdata, msg):
+    def _parse_hotword_detected(self, msg):
         topic = msg.topic
-        LOG.debug(topic+" "+str(msg.payload.decode()))
-        _, _, hotword_id, _ = topic.split('/')
-        data = json.loads(msg.payload.decode())
-        for h in self._hotword_detected_handlers.copy():
+        payload = msg.payload
+        if LOG.isEnabledFor(logging.DEBUG):
+            LOG.debug("%s %s", topic, payload.decode())
+        # Topic is always hermes/hotword/<hotword_id>/detected
+        hotword_id = topic[_HOTWORD_PREFIX_LEN:-_HOTWORD_SUFFIX_LEN]
+        data = _loads(payload)
+        return HotwordDetected(hotword_id, data['modelId'], data['siteId'])
+
+    def _handle_hotword_detected(self, client, userdata, msg):
+        hotword = self._parse_hotword_detected(msg)
+        for h in self._hotword_detected_handlers:
             try:
-                h(HotwordDetected(hotword_id, data['modelId'], data['siteId']))
+                h(hotword)
             except Exception as exc:
                 LOG.exception("Exception in %s: %s", h, exc)
 
-    def _handle_session_ended(self, client, userdata, msg):
-        topic = msg.topic
-        LOG.debug(topic+" "+str(msg.payload.decode()))
-        data = json.loads(msg.payload.decode())
+    def _parse_session_ended(self, msg):
+        payload = msg.payload
+        if LOG.isEnabledFor(logging.DEBUG):
+            LOG.debug("%s %s", msg.topic, payload.decode())
+        data = _loads(payload)
         termination = data['termination']
-        session_id = data['sessionId']
-        ended_msg = SessionEnded(
-            session_id, data['siteId'], data.get('customData'),
+        return SessionEnded(
+            data['sessionId'], sys.intern(data['siteId']), data.get('customData'),
             termination['reason'], termination.get('error')
         )
-        if session_id in self._suspended_sessions:
+
+    def _finish_suspended_session(self, session_id):
+        """
+        Remove a session the dialogue manager has ended from the suspended
+        sessions, returning its generator if there was one.
+        """
+        suspended = self._suspended_sessions.pop(session_id, None)
+        if suspended is None:
+            return None
+        gen_obj, session_manager = suspended
+        # The dialogue manager has already ended it, so nothing still queued
+        # for the session may be published.
+        session_manager.ended = True
+        session_manager._discard_pending()
+        return gen_obj
+
+    def _handle_session_ended(self, client, userdata, msg):
+        ended_msg = self._parse_session_ended(msg)
+        gen_obj = self._finish_suspended_session(ended_msg.session_id)
+        if gen_obj is not None:
             # Ending a suspended session
-            gen_obj = self._suspended_sessions[session_id]
             try:
-                gen_obj.send(ended_msg)
+                _advance_generator(gen_obj, ended_msg)
             except Exception as exc:
-                LOG.exception("Exception ending suspended session %s: %s", session_id, exc)
-            # Remove the suspended session
-            del self._suspended_sessions[session_id]
-        for h in self._session_ended_handlers.copy():
+                LOG.exception("Exception ending suspended session %s: %s", ended_msg.session_id, exc)
+        for h in self._session_ended_handlers:
             try:
                 h(ended_msg)
             except Exception as exc:
                 LOG.exception("Exception in %s: %s", h, exc)
-        if session_id in self._session_managers:
-            del self._session_managers[session_id]
 
     def connect(self):
         self._mqtt_client = mqtt.Client()
         self._mqtt_client.on_connect = self.on_connect
-
-        # These are here just to print random info for you
-        self._mqtt_client.message_callback_add("hermes/asr/#", self.asr)
-        self._mqtt_client.message_callback_add("hermes/nlu/#", self.nlu)
-
-        # This function responds to all intents
-        # TODO: intent namespacing? maybe that goes in subscription code
-        self._mqtt_client.message_callback_add("hermes/intent/#", self._handle_intent)
-        self._mqtt_client.message_callback_add("hermes/hotword/+/detected", self._handle_hotword_detected)
-        self._mqtt_client.message_callback_add("hermes/dialogueManager/sessionEnded", self._handle_session_ended)
+        for topic, callback in self._message_callbacks():
+            self._mqtt_client.message_callback_add(topic, callback)
 
         self._mqtt_client.connect(self.mqtt_host, self.mqtt_port, 60)
 
@@ -329,20 +583,207 @@ class SnipsListener(object):
         # manual interface.
         self._mqtt_client.loop_forever()
 
+    async def loop_forever_async(self, reconnect_interval=5):
+        """
+        Alternative to loop_forever() which runs the MQTT connection on the asyncio
+        event loop, using aiomqtt. Messages are parsed and sessions tracked on the
+        event loop in the order they arrive, while the intent, hotword and session
+        ended handlers run in the loop's default executor. Messages for the same
+        session are handled one after another, but a handler blocked on I/O
+        doesn't hold up other sessions, so handlers for different sessions may
+        run concurrently.
+        """
+        if aiomqtt is None:
+            raise RuntimeError("loop_forever_async() requires the aiomqtt package")
+
+        # One publisher for the lifetime of the loop, since SessionManagers of
+        # suspended sessions keep hold of it across reconnects.
+        self._mqtt_client = _AsyncPublisher(asyncio.get_running_loop())
+        callbacks = self._message_callbacks(asynchronous=True)
+        while True:
+            try:
+                async with aiomqtt.Client(self.mqtt_host, self.mqtt_port) as client:
+                    self._mqtt_client._client = client
+                    await client.subscribe(self._subscriptions())
+                    async for message in client.messages:
+                        msg = _Message(message.topic.value, message.payload)
+                        for topic, callback in callbacks:
+                            if message.topic.matches(topic):
+                                try:
+                                    callback(self._mqtt_client, None, msg)
+                                except Exception as exc:
+                                    LOG.exception("Exception handling message on %s: %s", msg.topic, exc)
+                                break
+            except aiomqtt.MqttError as exc:
+                LOG.warning("MQTT connection lost (%s), reconnecting in %s seconds", exc, reconnect_interval)
+                await asyncio.sleep(reconnect_interval)
+            finally:
+                self._mqtt_client._client = None
+
+    def _spawn(self, coro, description):
+        # The event loop only keeps weak references to tasks, so hold on to them
+        # until they're done, and log anything that goes wrong in them.
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        task.add_done_callback(functools.partial(_log_failure, description))
+        return task
+
+    def _run_in_session(self, session_id, coro, description):
+        # Chain tasks for the same session so they run in the order the messages
+        # arrived, and never run one session's generator from two threads at once.
+        previous = self._session_tasks.get(session_id)
+        task = self._spawn(_after_task(previous, coro), description)
+        self._session_tasks[session_id] = task
+        task.add_done_callback(functools.partial(self._session_task_done, session_id))
+
+    def _session_task_done(self, session_id, task):
+        if self._session_tasks.get(session_id) is task:
+            del self._session_tasks[session_id]
+
+    def _receive_intent(self, client, userdata, msg):
+        parsed = self._parse_intent(msg, self._suspended_sessions or self._session_tasks)
+        if parsed is not None:
+            data, handlers = parsed
+            self._run_in_session(
+                data['sessionId'], self._handle_intent_async(client, data, handlers),
+                "handling intent on " + msg.topic
+            )
+
+    async def _handle_intent_async(self, client, data, handlers):
+        started = self._start_intent(client, data, handlers)
+        if started is None:
+            return
+
+        loop = asyncio.get_running_loop()
+        intent_obj, gen_obj, handlers = started
+        if gen_obj is not None:
+            # Resumed session
+            LOG.debug("Sending into generator for %s", intent_obj.session_id)
+            await self._do_generator_turn_async(gen_obj, intent_obj)
+        else:
+            # new session
+            for h, is_gen in handlers:
+                try:
+                    if is_gen:
+                        LOG.debug("Getting generator from %s", h)
+                        await self._do_generator_turn_async(h(intent_obj), intent_obj, is_start=True)
+                    else:
+                        await loop.run_in_executor(None, h, intent_obj)
+                except Exception as exc:
+                    LOG.exception("Exception in %s: %s", h, exc)
+
+    async def _do_generator_turn_async(self, gen_obj, intent_obj, is_start=False):
+        loop = asyncio.get_running_loop()
+        finished, result = await loop.run_in_executor(None, _advance_generator, gen_obj, intent_obj, is_start)
+        if not self._apply_generator_turn(gen_obj, intent_obj, finished, result):
+            await loop.run_in_executor(None, _reject_turn, gen_obj)
+
+    def _receive_hotword_detected(self, client, userdata, msg):
+        hotword = self._parse_hotword_detected(msg)
+        self._spawn(self._handle_hotword_detected_async(hotword), "handling hotword on " + msg.topic)
+
+    async def _handle_hotword_detected_async(self, hotword):
+        loop = asyncio.get_running_loop()
+        for h in self._hotword_detected_handlers:
+            try:
+                await loop.run_in_executor(None, h, hotword)
+            except Exception as exc:
+                LOG.exception("Exception in %s: %s", h, exc)
+
+    def _receive_session_ended(self, client, userdata, msg):
+        ended_msg = self._parse_session_ended(msg)
+        self._run_in_session(
+            ended_msg.session_id, self._handle_session_ended_async(ended_msg), "handling end of session"
+        )
+
+    async def _handle_session_ended_async(self, ended_msg):
+        loop = asyncio.get_running_loop()
+        gen_obj = self._finish_suspended_session(ended_msg.session_id)
+        if gen_obj is not None:
+            # Ending a suspended session
+            try:
+                await loop.run_in_executor(None, _advance_generator, gen_obj, ended_msg)
+            except Exception as exc:
+                LOG.exception("Exception ending suspended session %s: %s", ended_msg.session_id, exc)
+        for h in self._session_ended_handlers:
+            try:
+                await loop.run_in_executor(None, h, ended_msg)
+            except Exception as exc:
+                LOG.exception("Exception in %s: %s", h, exc)
+
+
+def _advance_generator(gen_obj, value, is_start=False):
+    """
+    Run an intent handler generator up to its next yield, returning
+    (finished, yielded value or return value). StopIteration is caught here as
+    it can't be passed through an asyncio future.
+    """
+    try:
+        if is_start:
+            return False, next(gen_obj)
+        return False, gen_obj.send(value)
+    except StopIteration as exc:
+        return True, exc.value
+
+
+def _reject_turn(gen_obj):
+    gen_obj.throw(TypeError(
+        "Intent handler generators must yield text or (text: str, intent_filters: list)"
+    ))
+
+
+async def _after_task(previous, coro):
+    if previous is not None:
+        # Only wait for it; its own failure is logged by its done callback
+        await asyncio.wait([previous])
+    await coro
+
+
+def _log_failure(description, future):
+    if not future.cancelled() and future.exception() is not None:
+        exc = future.exception()
+        LOG.error("Exception %s: %s", description, exc, exc_info=exc)
+
+
+_Message = collections.namedtuple('_Message', ('topic', 'payload'))
+
+
+class _AsyncPublisher(object):
+    """
+    Stands in for the paho client passed to handlers and SessionManagers when
+    running under loop_forever_async(), handing publishes from any thread over
+    to the current aiomqtt client on the event loop.
+    """
+
+    def __init__(self, loop):
+        self._loop = loop
+        # Swapped by loop_forever_async() on each (re)connection
+        self._client = None
+
+    def publish(self, topic, payload=None, qos=0):
+        future = asyncio.run_coroutine_threadsafe(self._publish(topic, payload, qos), self._loop)
+        future.add_done_callback(functools.partial(_log_failure, "publishing to " + topic))
+        return future
+
+    async def _publish(self, topic, payload, qos):
+        if self._client is None:
+            raise aiomqtt.MqttError("Not connected to MQTT")
+        await self._client.publish(topic, payload, qos=qos)
+
 
 class FallbackHandler(SnipsListener):
 
+    # The reply never changes, so its JSON is encoded once up front
+    _SAY_UNRECOGNISED_TMPL = b'{"sessionId":%b,"siteId":%b,"text":' + _dumps("Sorry, I didn't understand that.") + b'}'
+
     @session_ended
     def explain_unrecognised(self, data):
         if data.reason == "intentNotRecognized":
-            payload = {
-                'sessionId': data.session_id,
-                'siteId': data.site_id,
-                'text': "Sorry, I didn't understand that."
-            }
             self._mqtt_client.publish(
                 'hermes/tts/say',
-                payload=json.dumps(payload)
+                payload=self._SAY_UNRECOGNISED_TMPL % (_dumps(data.session_id), _dumps(data.site_id)),
+                qos=0
             )
 
 
@@ -357,6 +798,8 @@ def run_fallback_handler():
         }
         if 'mqtt_port' in config:
             listener_args['mqtt_port'] = int(config['mqtt_port'])
+        if 'debug' in config:
+            listener_args['debug'] = bool(config['debug'])
         if 'logging_config' in config:
             logging.config.dictConfig(config['logging_config'])
         else:
@@ -1,3 +1,4 @@
+import asyncio
 import json
 import logging
 from unittest import mock
@@ -5,7 +6,11 @@ from unittest import mock
 import pytest
 import paho.mqtt.client
 
-from snipslistener import intent, SnipsListener, IntentDetected, SessionEnded
+import snipslistener
+from snipslistener import (
+    intent, hotword_detected, SnipsListener, SessionManager, FallbackHandler,
+    IntentDetected, SessionEnded, HotwordDetected, Slot, Range, ContinueSession,
+)
 
 LOG = logging.getLogger(__name__)
 
@@ -42,6 +47,29 @@ class ExampleSkill(SnipsListener):
         LOG.info("Starting single-turn dialogue")
         data.session_manager.end_session("Single and final reply to user")
 
+    @intent('namespaced', namespace='someuser')
+    def namespaced(self, data):
+        data.session_manager.end_session("Namespaced reply")
+
+    @hotword_detected
+    def hotword(self, data):
+        self.last_hotword = data
+
+    @intent('slotted')
+    def slotted(self, data):
+        self.last_intent = data
+
+
+class NamespacedSkill(SnipsListener):
+
+    def __init__(self, **kwargs):
+        super().__init__('test-mqtt-example', **kwargs)
+
+    @intent('first', namespace='someuser')
+    @intent('second', namespace='someuser')
+    def handle(self, data):
+        data.session_manager.end_session()
+
 
 class ExampleMessage(object):
 
@@ -50,6 +78,28 @@ class ExampleMessage(object):
         self.payload = payload.encode('utf-8')
 
 
+def intent_message(intent_name):
+    return ExampleMessage(
+        "hermes/intent/" + intent_name, json.dumps({
+            'sessionId': 'aaaa-bbbb-cccc',
+            'siteId': 'default',
+            'input': 'foo bar baz',
+            'intent': {
+                'intentName': intent_name,
+                'probability': 0.723,
+            },
+            'slots': []
+        })
+    )
+
+
+def assert_published(mqtt_client, topic, payload):
+    args, kwargs = mqtt_client.publish.call_args
+    assert args == (topic,)
+    assert json.loads(kwargs['payload']) == payload
+    assert kwargs['qos'] == 0
+
+
 @pytest.fixture
 def skill():
     return ExampleSkill()
@@ -62,69 +112,36 @@ def mqtt_client():
 
 @pytest.fixture
 def multiturn_intent():
-    return ExampleMessage(
-        "hermes/intent/multiturn", json.dumps({
-            'sessionId': 'aaaa-bbbb-cccc',
-            'siteId': 'default',
-            'input': 'foo bar baz',
-            'intent': {
-                'intentName': 'multiturn',
-                'probability': 0.723,
-            },
-            'slots': []
-        })
-    )
+    return intent_message('multiturn')
 
 
 @pytest.fixture
 def singleturn_intent():
-    return ExampleMessage(
-        "hermes/intent/singleturn", json.dumps({
-            'sessionId': 'aaaa-bbbb-cccc',
-            'siteId': 'default',
-            'input': 'foo bar baz',
-            'intent': {
-                'intentName': 'singleturn',
-                'probability': 0.723,
-            },
-            'slots': []
-        })
-    )
-
+    return intent_message('singleturn')
 
 
 def test_multiturn_generator(skill, mqtt_client, multiturn_intent):
     skill._handle_intent(mqtt_client, None, multiturn_intent)
-    mqtt_client.publish.assert_called_with(
-        'hermes/dialogueManager/continueSession',
-        payload=json.dumps({
-            'sessionId': 'aaaa-bbbb-cccc',
-            'text': "Reply to user 1",
-        })
-    )
+    assert_published(mqtt_client, 'hermes/dialogueManager/continueSession', {
+        'sessionId': 'aaaa-bbbb-cccc',
+        'text': "Reply to user 1",
+    })
     assert len(skill._suspended_sessions) == 1
-    assert len(skill._session_managers) == 1
+    _, session_manager = skill._suspended_sessions['aaaa-bbbb-cccc']
     skill._handle_intent(mqtt_client, None, multiturn_intent)
-    mqtt_client.publish.assert_called_with(
-        'hermes/dialogueManager/continueSession',
-        payload=json.dumps({
-            'sessionId': 'aaaa-bbbb-cccc',
-            'text': "Reply to user 2",
-            'intentFilter': ['intent_filter_1', "intent_filter_2"],
-        })
-    )
+    assert_published(mqtt_client, 'hermes/dialogueManager/continueSession', {
+        'sessionId': 'aaaa-bbbb-cccc',
+        'text': "Reply to user 2",
+        'intentFilter': ['intent_filter_1', "intent_filter_2"],
+    })
     assert len(skill._suspended_sessions) == 1
-    assert len(skill._session_managers) == 1
+    assert skill._suspended_sessions['aaaa-bbbb-cccc'][1] is session_manager
     skill._handle_intent(mqtt_client, None, multiturn_intent)
-    mqtt_client.publish.assert_called_with(
-        'hermes/dialogueManager/endSession',
-        payload=json.dumps({
-            'sessionId': 'aaaa-bbbb-cccc',
-            'text': "final text to user",
-        })
-    )
+    assert_published(mqtt_client, 'hermes/dialogueManager/endSession', {
+        'sessionId': 'aaaa-bbbb-cccc',
+        'text': "final text to user",
+    })
     assert len(skill._suspended_sessions) == 0
-    assert len(skill._session_managers) == 1
     skill._handle_session_ended(mqtt_client, None, ExampleMessage(
         'hermes/dialogueManager/sessionEnded',
         payload=json.dumps({
@@ -134,20 +151,15 @@ def test_multiturn_generator(skill, mqtt_client, multiturn_intent):
         })
     ))
     assert len(skill._suspended_sessions) == 0
-    assert len(skill._session_managers) == 0
 
 
 def test_premature_end(skill, mqtt_client, multiturn_intent):
     skill._handle_intent(mqtt_client, None, multiturn_intent)
-    mqtt_client.publish.assert_called_with(
-        'hermes/dialogueManager/continueSession',
-        payload=json.dumps({
-            'sessionId': 'aaaa-bbbb-cccc',
-            'text': "Reply to user 1",
-        })
-    )
+    assert_published(mqtt_client, 'hermes/dialogueManager/continueSession', {
+        'sessionId': 'aaaa-bbbb-cccc',
+        'text': "Reply to user 1",
+    })
     assert len(skill._suspended_sessions) == 1
-    assert len(skill._session_managers) == 1
     skill._handle_session_ended(mqtt_client, None, ExampleMessage(
         'hermes/dialogueManager/sessionEnded',
         payload=json.dumps({
@@ -157,27 +169,359 @@ def test_premature_end(skill, mqtt_client, multiturn_intent):
         })
     ))
     assert len(skill._suspended_sessions) == 0
-    assert len(skill._session_managers) == 0
 
 
 def test_single_turn(skill, mqtt_client, singleturn_intent):
     skill._handle_intent(mqtt_client, None, singleturn_intent)
-    mqtt_client.publish.assert_called_with(
-        'hermes/dialogueManager/endSession',
+    assert_published(mqtt_client, 'hermes/dialogueManager/endSession', {
+        'sessionId': 'aaaa-bbbb-cccc',
+        'text': "Single and final reply to user",
+    })
+    assert len(skill._suspended_sessions) == 0
+    skill._handle_session_ended(mqtt_client, None, ExampleMessage(
+        'hermes/dialogueManager/sessionEnded',
         payload=json.dumps({
             'sessionId': 'aaaa-bbbb-cccc',
-            'text': "Single and final reply to user",
+            'siteId': 'default',
+            'termination': {'reason': 'nominal'}
         })
-    )
+    ))
     assert len(skill._suspended_sessions) == 0
-    assert len(skill._session_managers) == 1
+
+
+@pytest.mark.parametrize('intent_name,reply', [
+    ('singleturn', "Single and final reply to user"),
+    ('someuser:singleturn', "Single and final reply to user"),
+    ('someuser:namespaced', "Namespaced reply"),
+])
+def test_intent_namespaces(skill, mqtt_client, intent_name, reply):
+    skill._handle_intent(mqtt_client, None, intent_message(intent_name))
+    assert_published(mqtt_client, 'hermes/dialogueManager/endSession', {
+        'sessionId': 'aaaa-bbbb-cccc',
+        'text': reply,
+    })
+
+
+@pytest.mark.parametrize('intent_name', ['namespaced', 'otheruser:namespaced'])
+def test_intent_namespace_mismatch(skill, mqtt_client, intent_name):
+    skill._handle_intent(mqtt_client, None, intent_message(intent_name))
+    mqtt_client.publish.assert_not_called()
+
+
+def test_end_session_without_text(mqtt_client):
+    session_manager = SessionManager('aaaa-bbbb-cccc', 'default', mqtt_client)
+    session_manager.end_session()
+    assert_published(mqtt_client, 'hermes/dialogueManager/endSession', {
+        'sessionId': 'aaaa-bbbb-cccc',
+    })
+    assert session_manager.ended
+    # No batching state unless batching is enabled
+    assert session_manager._lock is None
+    session_manager._discard_pending()
+
+
+def test_slots(skill, mqtt_client):
+    skill._handle_intent(mqtt_client, None, ExampleMessage(
+        "hermes/intent/slotted", json.dumps({
+            'sessionId': 'aaaa-bbbb-cccc',
+            'siteId': 'default',
+            'input': 'weather in london',
+            'intent': {
+                'intentName': 'slotted',
+                'confidenceScore': 0.9,
+            },
+            'slots': [{
+                'slotName': 'city',
+                'rawValue': 'london',
+                'value': {'kind': 'Custom', 'value': 'London'},
+                'range': {'start': 11, 'end': 17},
+                'entity': 'city',
+            }]
+        })
+    ))
+    slots = skill.last_intent.slots
+    assert len(slots) == 1
+    assert list(slots) == ['city']
+    assert slots['city'] == Slot(
+        slot_name='city',
+        raw_value='london',
+        value='London',
+        value_kind='Custom',
+        range=Range(start=11, end=17),
+        entity='city',
+        text='london'
+    )
+    assert 'town' not in slots
+
+
+def test_subscribes_to_all_intents(skill, mqtt_client):
+    skill.on_connect(mqtt_client, None, {}, 0)
+    mqtt_client.subscribe.assert_called_once_with([
+        ("hermes/intent/#", 0),
+        ("hermes/hotword/+/detected", 0),
+        ("hermes/dialogueManager/sessionEnded", 0),
+    ])
+
+
+def test_subscribes_to_namespaced_intents(mqtt_client):
+    NamespacedSkill(debug=True).on_connect(mqtt_client, None, {}, 0)
+    mqtt_client.subscribe.assert_called_once()
+    assert sorted(mqtt_client.subscribe.call_args.args[0]) == [
+        ("hermes/asr/#", 0),
+        ("hermes/dialogueManager/sessionEnded", 0),
+        ("hermes/hotword/+/detected", 0),
+        ("hermes/intent/someuser:first", 0),
+        ("hermes/intent/someuser:second", 0),
+        ("hermes/nlu/#", 0),
+    ]
+
+
+def test_batched_publishes(mqtt_client):
+    session_manager = SessionManager('aaaa-bbbb-cccc', 'default', mqtt_client, batch_window_ms=60000)
+    session_manager.say("Hello")
+    session_manager.continue_session("Anything else?")
+    mqtt_client.publish.assert_not_called()
+    session_manager.end_session()
+    assert [c.args[0] for c in mqtt_client.publish.call_args_list] == [
+        'hermes/tts/say',
+        'hermes/dialogueManager/continueSession',
+        'hermes/dialogueManager/endSession',
+    ]
+    assert session_manager._flush_timer is None
+
+
+def test_batched_publishes_dropped_when_session_ends(skill, mqtt_client, multiturn_intent):
+    skill.batch_window_ms = 60000
+    skill._handle_intent(mqtt_client, None, multiturn_intent)
+    _, session_manager = skill._suspended_sessions['aaaa-bbbb-cccc']
     skill._handle_session_ended(mqtt_client, None, ExampleMessage(
         'hermes/dialogueManager/sessionEnded',
         payload=json.dumps({
             'sessionId': 'aaaa-bbbb-cccc',
             'siteId': 'default',
-            'termination': {'reason': 'nominal'}
+            'termination': {'reason': 'timeout'}
         })
     ))
-    assert len(skill._suspended_sessions) == 0
-    assert len(skill._session_managers) == 0
+    assert session_manager.ended
+    assert session_manager._flush_timer is None
+    session_manager._flush()
+    mqtt_client.publish.assert_not_called()
+
+
+def test_batch_window_elapses(mqtt_client):
+    session_manager = SessionManager('aaaa-bbbb-cccc', 'default', mqtt_client, batch_window_ms=100)
+    session_manager.say("Hello")
+    flush_timer = session_manager._flush_timer
+    flush_timer.join()
+    assert_published(mqtt_client, 'hermes/tts/say', {
+        'sessionId': 'aaaa-bbbb-cccc',
+        'siteId': 'default',
+        'text': "Hello",
+    })
+
+
+def test_hotword_detected(skill, mqtt_client):
+    skill._handle_hotword_detected(mqtt_client, None, ExampleMessage(
+        'hermes/hotword/hey_snips/detected',
+        payload=json.dumps({
+            'siteId': 'default',
+            'modelId': 'hey_snips_model',
+        })
+    ))
+    assert skill.last_hotword == HotwordDetected('hey_snips', 'hey_snips_model', 'default')
+
+
+def test_unhandled_intent_not_parsed(skill, mqtt_client):
+    skill._handle_intent(mqtt_client, None, ExampleMessage("hermes/intent/unhandled", "not json"))
+    mqtt_client.publish.assert_not_called()
+
+
+def test_handlers_inherited_and_overridden():
+
+    class DerivedSkill(ExampleSkill):
+
+        def single_turn(self, data):
+            pass
+
+        @intent('derived')
+        def derived(self, data):
+            pass
+
+    skill = DerivedSkill()
+    assert set(skill._intent_handlers) == {'multiturn', 'someuser:namespaced', 'slotted', 'derived'}
+    assert skill._intent_handlers['derived'] == ((skill.derived, False),)
+    assert skill._hotword_detected_handlers == {skill.hotword}
+
+
+def test_static_and_class_method_handlers():
+
+    class MethodTypesSkill(SnipsListener):
+
+        @classmethod
+        @intent('cm')
+        def class_method(cls, data):
+            pass
+
+        @staticmethod
+        @hotword_detected
+        def static_method(data):
+            pass
+
+        @property
+        def broken(self):
+            raise AssertionError("Properties shouldn't be evaluated")
+
+    skill = MethodTypesSkill('test-mqtt-example')
+    assert skill._intent_handlers == {'cm': ((skill.class_method, False),)}
+    assert skill._hotword_detected_handlers == {skill.static_method}
+
+
+def run_async_listener(listener, monkeypatch, *connections):
+    """
+    Run listener.loop_forever_async() briefly against fake aiomqtt clients, each
+    of which delivers one of the given lists of messages and then disconnects.
+    Returns the (topic, payload) pairs published on each connection.
+    """
+    aiomqtt = pytest.importorskip('aiomqtt')
+    connections = list(connections)
+    timeout = 0.2 * len(connections) + 1
+    published = []
+
+    class FakeClient(object):
+
+        def __init__(self, hostname, port):
+            self.published = []
+            published.append(self.published)
+
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *exc_info):
+            pass
+
+        async def subscribe(self, topics):
+            pass
+
+        async def publish(self, topic, payload, qos=0):
+            self.published.append((topic, json.loads(payload)))
+
+        @property
+        async def messages(self):
+            for msg in connections.pop(0):
+                yield aiomqtt.Message(aiomqtt.Topic(msg.topic), msg.payload, 0, False, 1, None)
+            # Let the handlers finish before disconnecting
+            await asyncio.sleep(0.2)
+            if connections:
+                raise aiomqtt.MqttError("Disconnected")
+            await asyncio.sleep(1)
+
+    async def run_briefly():
+        try:
+            await asyncio.wait_for(listener.loop_forever_async(reconnect_interval=0), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    monkeypatch.setattr(snipslistener.aiomqtt, 'Client', FakeClient)
+    asyncio.run(run_briefly())
+    return published
+
+
+def session_ended_message(reason='nominal'):
+    return ExampleMessage(
+        'hermes/dialogueManager/sessionEnded',
+        payload=json.dumps({
+            'sessionId': 'aaaa-bbbb-cccc',
+            'siteId': 'default',
+            'termination': {'reason': reason}
+        })
+    )
+
+
+def test_loop_forever_async(skill, monkeypatch, singleturn_intent):
+    published = run_async_listener(skill, monkeypatch, [singleturn_intent])
+    assert published == [[('hermes/dialogueManager/endSession', {
+        'sessionId': 'aaaa-bbbb-cccc',
+        'text': "Single and final reply to user",
+    })]]
+
+
+def test_loop_forever_async_reconnect(skill, monkeypatch, multiturn_intent):
+    published = run_async_listener(skill, monkeypatch, [multiturn_intent], [multiturn_intent])
+    assert published == [
+        [('hermes/dialogueManager/continueSession', {
+            'sessionId': 'aaaa-bbbb-cccc',
+            'text': "Reply to user 1",
+        })],
+        [('hermes/dialogueManager/continueSession', {
+            'sessionId': 'aaaa-bbbb-cccc',
+            'text': "Reply to user 2",
+            'intentFilter': ['intent_filter_1', "intent_filter_2"],
+        })],
+    ]
+
+
+def test_loop_forever_async_session_order(skill, monkeypatch, multiturn_intent, caplog):
+    published = run_async_listener(skill, monkeypatch, [
+        ExampleMessage("hermes/intent/multiturn", "not json"),
+        multiturn_intent,
+        session_ended_message('abortedByUser'),
+    ])
+    assert published == [[('hermes/dialogueManager/continueSession', {
+        'sessionId': 'aaaa-bbbb-cccc',
+        'text': "Reply to user 1",
+    })]]
+    assert skill._suspended_sessions == {}
+    assert skill._session_tasks == {}
+    errors = [r for r in caplog.records if r.levelno >= logging.ERROR]
+    assert len(errors) == 1
+    assert "hermes/intent/multiturn" in errors[0].getMessage()
+
+
+def test_yield_continue_session(mqtt_client):
+
+    class ContinueSessionSkill(SnipsListener):
+
+        @intent('continued')
+        def continued(self, data):
+            yield ContinueSession("Which one?", ['choice'])
+
+    skill = ContinueSessionSkill('test-mqtt-example')
+    skill._handle_intent(mqtt_client, None, intent_message('continued'))
+    assert_published(mqtt_client, 'hermes/dialogueManager/continueSession', {
+        'sessionId': 'aaaa-bbbb-cccc',
+        'text': "Which one?",
+        'intentFilter': ['choice'],
+    })
+    assert len(skill._suspended_sessions) == 1
+
+
+def test_fallback_handler(mqtt_client):
+    handler = FallbackHandler('test-mqtt-example')
+    handler._mqtt_client = mqtt_client
+    handler._handle_session_ended(mqtt_client, None, ExampleMessage(
+        'hermes/dialogueManager/sessionEnded',
+        payload=json.dumps({
+            'sessionId': 'aaaa-bbbb-cccc',
+            'siteId': 'default',
+            'termination': {'reason': 'intentNotRecognized'}
+        })
+    ))
+    assert_published(mqtt_client, 'hermes/tts/say', {
+        'sessionId': 'aaaa-bbbb-cccc',
+        'siteId': 'default',
+        'text': "Sorry, I didn't understand that.",
+    })
+
+
+def test_message_callbacks():
+    skill = NamespacedSkill()
+    assert sorted(topic for topic, _ in skill._message_callbacks()) == [
+        "hermes/dialogueManager/sessionEnded",
+        "hermes/hotword/+/detected",
+        "hermes/intent/someuser:first",
+        "hermes/intent/someuser:second",
+    ]
+    assert [topic for topic, _ in FallbackHandler('test-mqtt-example')._message_callbacks()] == [
+        "hermes/hotword/+/detected",
+        "hermes/dialogueManager/sessionEnded",
+    ]